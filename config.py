@@ -18,6 +18,10 @@ class Config:
     GEMINI_TEMPERATURE = 0.5
     GEMINI_VERBOSE = True
     
+    # Client-side Gemini quota; the defaults match the gemini-2.0-flash free tier
+    GEMINI_RPM_LIMIT = int(os.getenv("GEMINI_RPM_LIMIT", "15"))
+    GEMINI_TPM_LIMIT = int(os.getenv("GEMINI_TPM_LIMIT", "1000000"))
+    
     # Quota Handling Configuration
     MAX_RETRIES = 3  # Maximum number of retries for quota errors
     BASE_RETRY_DELAY = 60  # Base delay in seconds
@@ -26,6 +30,7 @@ class Config:
     # Crew Configuration
     CREW_MAX_RETRIES = 2  # Maximum retries at crew level
     CREW_VERBOSE_LEVEL = 2
+    FUSED_MODE = os.getenv("FUSED_MODE", "false").lower() == "true"  # One combined task instead of three
     
     @classmethod
     def validate_api_keys(cls):
@@ -56,6 +61,7 @@ class Config:
         print(f"   - Max Retries: {cls.MAX_RETRIES}")
         print(f"   - Base Retry Delay: {cls.BASE_RETRY_DELAY}s")
         print(f"   - Exponential Backoff: {cls.EXPONENTIAL_BACKOFF}")
+        print(f"   - Gemini Rate Limit: {cls.GEMINI_RPM_LIMIT} RPM, {cls.GEMINI_TPM_LIMIT} TPM")
         print(f"   - Google API Key: {'✓ Set' if cls.GOOGLE_API_KEY else '❌ Missing'}")
         print(f"   - Serper API Key: {'✓ Set' if cls.SERPER_API_KEY else '❌ Missing'}")
         print()
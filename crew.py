@@ -1,21 +1,92 @@
 from crewai import Crew, Process
-from agents import market_research_analyst, technology_expert, business_consultant
-from tasks import create_tasks, create_emergency_tasks
+from tasks import create_tasks, create_tasks_fused, create_emergency_tasks
+from config import Config
+from agents import run_with_cancel_event
 from dotenv import load_dotenv
+import asyncio
 import sys
 import os
+import random
+import re
 import time
 import logging
-import signal
 import threading
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pydantic import BaseModel
 
 load_dotenv()
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+# Set up logging for the CLI, the only place the level is chosen; the LLM
+# retry path logs per-attempt details at DEBUG so it stays quiet here
+logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# Shared by every strategy attempt so fallbacks reuse warm threads instead of
+# each per-call event loop spinning up its own default executor
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='crew')
+
+# Google API keys are "AIza" followed by 35 URL-safe characters
+_GOOGLE_API_KEY_RE = re.compile(r'AIza[0-9A-Za-z_\-]{35}')
+
+# Product names may use any punctuation, but must contain at least one letter
+_HAS_LETTER_RE = re.compile(r'[^\W\d_]')
+_PLACEHOLDER_NAMES = {'test', 'asdf', 'asdfgh', 'qwerty', 'none', 'null', 'n/a', 'product', 'anything'}
+
+# Crew runs in progress, consulted by the thread excepthook below
+_ACTIVE_RUNS = set()
+_RUNS_LOCK = threading.Lock()
+
+class _CrewRun:
+    """One kickoff of a crew, with its own cancel flag and first async task error"""
+    
+    def __init__(self, crew):
+        self.crew = crew
+        self.cancelled = threading.Event()
+        self.error = None
+    
+    def owns(self, thread):
+        return any(task.thread is thread for task in self.crew.tasks if task.async_execution)
+    
+    def kickoff(self):
+        """Run the crew, failing as soon as any of its async tasks dies"""
+        with _RUNS_LOCK:
+            _ACTIVE_RUNS.add(self)
+        try:
+            result = run_with_cancel_event(self.cancelled, self.crew.kickoff)
+        except Exception:
+            # Report the task that died, not the cancellation it caused
+            if self.error is not None:
+                raise self.error
+            raise
+        finally:
+            with _RUNS_LOCK:
+                _ACTIVE_RUNS.discard(self)
+        
+        if self.error is not None:
+            raise self.error
+        for task in self.crew.tasks:
+            if task.async_execution and task.output is None:
+                raise RuntimeError(f"The {task.agent.role} task finished without output")
+        return result
+
+# CrewAI runs async_execution tasks in bare threads and never looks at their
+# exceptions. Claim those of our crews' tasks: keep the first error and cancel
+# the run at once, so the dependent task does not run on half its context
+_default_excepthook = threading.excepthook
+
+def _record_thread_error(args):
+    with _RUNS_LOCK:
+        for run in _ACTIVE_RUNS:
+            if run.owns(args.thread):
+                if run.error is None:
+                    run.error = args.exc_value
+                run.cancelled.set()
+                return
+    _default_excepthook(args)
+
+threading.excepthook = _record_thread_error
+
 class AdaptiveCrewHandler:
     """Adaptive handler that tries different strategies based on failures"""
     
@@ -47,6 +118,9 @@ class AdaptiveCrewHandler:
         if strategy['tasks'] == 'emergency':
             tasks = create_emergency_tasks(self.product_name)
             print("🆘 Using emergency simplified tasks (no web search)")
+        elif Config.FUSED_MODE:
+            tasks = create_tasks_fused(self.product_name)
+            print("🧩 Using fused single-task analysis")
         elif strategy['tasks'] == 'quick':
             tasks = create_tasks(self.product_name)  # Regular tasks but with timeout
             print("⚡ Using quick analysis tasks")
@@ -54,39 +128,47 @@ class AdaptiveCrewHandler:
             tasks = create_tasks(self.product_name)
             print("🔍 Using full analysis tasks")
         
-        # Create crew with strategy-specific settings
+        # A new crew around the fresh tasks on every attempt: Tasks keep their
+        # output and worker thread once run, so they must never be shared with
+        # an earlier attempt
         crew = Crew(
-            agents=[market_research_analyst, technology_expert, business_consultant],
+            # Agents come from the tasks, since the market task's agent
+            # depends on the product category
+            agents=list({id(task.agent): task.agent for task in tasks}.values()),
             tasks=tasks,
             verbose=0 if strategy['tasks'] == 'emergency' else 1,
-            process=Process.sequential,
+            process=Process.sequential,  # async_execution tasks still run concurrently
             max_execution_time=strategy['timeout'],
         )
         
         return crew
     
-    def execute_with_timeout(self, crew, timeout_seconds):
+    async def execute_with_timeout(self, crew, timeout_seconds):
         """Execute crew with specific timeout"""
-        result = [None]
-        error = [None]
-        
-        def run_crew():
-            try:
-                result[0] = crew.kickoff()
-            except Exception as e:
-                error[0] = e
-        
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(run_crew)
+        loop = asyncio.get_running_loop()
+        # The run has its own cancel flag: abandoning it stops only its calls,
+        # not those of other analyses running in the same process
+        run = _CrewRun(crew)
+        future = loop.run_in_executor(_EXECUTOR, run.kickoff)
+        try:
+            # shield() keeps the run awaitable after the timeout fires
+            return await asyncio.wait_for(asyncio.shield(future), timeout_seconds)
+        except asyncio.TimeoutError:
+            # The kickoff thread cannot be killed: stop its Gemini calls and let
+            # it wind down before the next strategy reuses the shared agents
+            print("⏳ Stopping the timed-out analysis...")
+            run.cancelled.set()
             try:
-                future.result(timeout=timeout_seconds)
-                if error[0]:
-                    raise error[0]
-                return result[0]
-            except FuturesTimeoutError:
-                raise TimeoutError(f"Crew execution timed out after {timeout_seconds} seconds")
+                await future
+            except Exception:
+                pass  # Expected: its remaining calls fail with GenerationCancelled
+            raise TimeoutError(f"Crew execution timed out after {timeout_seconds} seconds")
+        except asyncio.CancelledError:
+            # Interrupted (e.g. Ctrl+C): let the run stop quickly so exit doesn't wait on it
+            run.cancelled.set()
+            raise
 
-def create_crewai_setup(product_name, max_attempts=3):
+async def create_crewai_setup(product_name, max_attempts=3):
     """Create and execute CrewAI setup with adaptive fallback strategies"""
     
     print(f"\n{'='*60}")
@@ -112,7 +194,11 @@ def create_crewai_setup(product_name, max_attempts=3):
             
             # Execute with timeout
             print(f"🔄 Executing {strategy['name'].lower()}...")
-            result = handler.execute_with_timeout(crew, strategy['timeout'])
+            result = await handler.execute_with_timeout(crew, strategy['timeout'])
+            # A structured result (the fused FullReport) would otherwise be
+            # printed and saved as a one-line repr
+            if isinstance(result, BaseModel):
+                result = result.model_dump_json(indent=2)
             
             print(f"\n✅ SUCCESS with {strategy['name']}!")
             print(f"{'='*60}")
@@ -134,9 +220,9 @@ def create_crewai_setup(product_name, max_attempts=3):
             if "overloaded" in error_str or "503" in error_str:
                 print(f"🚨 Service overloaded detected")
                 if attempt < max_attempts - 1:
-                    wait_time = (attempt + 1) * 60  # 1, 2, 3 minutes
-                    print(f"⏳ Waiting {wait_time} seconds for service to recover...")
-                    time.sleep(wait_time)
+                    wait_time = random.uniform(0, (attempt + 1) * 60)  # Up to 1, 2, 3 minutes
+                    print(f"⏳ Waiting {wait_time:.0f} seconds for service to recover...")
+                    await asyncio.sleep(wait_time)
                     continue
                 else:
                     return f"❌ Service is overloaded and all retry attempts failed. Please try again in 10-15 minutes."
@@ -144,9 +230,9 @@ def create_crewai_setup(product_name, max_attempts=3):
             elif any(indicator in error_str for indicator in ["quota", "rate limit", "429"]):
                 print(f"📊 API quota/rate limit reached")
                 if attempt < max_attempts - 1:
-                    wait_time = (attempt + 1) * 90  # 1.5, 3, 4.5 minutes
-                    print(f"⏳ Waiting {wait_time} seconds for quota refresh...")
-                    time.sleep(wait_time)
+                    wait_time = random.uniform(0, (attempt + 1) * 90)  # Up to 1.5, 3, 4.5 minutes
+                    print(f"⏳ Waiting {wait_time:.0f} seconds for quota refresh...")
+                    await asyncio.sleep(wait_time)
                     continue
                 else:
                     return f"❌ API quota exhausted. Please try again later when your quota refreshes."
@@ -184,6 +270,15 @@ def get_product_name():
             print("❌ Product name too long. Please use a shorter name (max 100 characters).")
             continue
         
+        # Cheap local checks so a typo doesn't launch a full, billed analysis
+        if not _HAS_LETTER_RE.search(product_name):
+            print("❌ Please include at least one letter in the product name.")
+            continue
+        
+        if product_name.lower() in _PLACEHOLDER_NAMES:
+            print("❌ That looks like a placeholder. Please enter a real product name.")
+            continue
+        
         # Simple validation
         if len(product_name.split()) > 5:
             print("💡 Consider using a shorter, more specific product name for better results.")
@@ -213,34 +308,36 @@ def check_service_status():
     
     print("✅ API keys found")
     
-    # Try to test Gemini availability (optional)
-    try:
-        from agents import llm
-        test_result = llm.invoke("test")
-        print("✅ Gemini service is responsive")
-        return True
-    except Exception as e:
-        if "overloaded" in str(e).lower() or "503" in str(e):
-            print("⚠️ Gemini service is currently overloaded but will retry automatically")
-            return True
-        else:
-            print(f"⚠️ Gemini service test failed: {str(e)[:100]}...")
-            return True  # Continue anyway, let the adaptive handler deal with it
+    # Check the key locally rather than spending a billed round trip on a probe;
+    # service availability is handled by the adaptive retries during analysis.
+    # Key formats can change, so an unusual key only earns a warning
+    if _GOOGLE_API_KEY_RE.fullmatch(os.getenv('GOOGLE_API_KEY').strip()):
+        print("✅ Gemini API key format looks valid")
+    else:
+        print("⚠️ GOOGLE_API_KEY does not look like a typical Google API key.")
+        print("Continuing anyway; check the value in your .env file if the analysis fails.")
+    
+    return True
 
 def save_results(results, product_name):
     """Save results to a file with error handling"""
     try:
         # Create a safe filename
-        safe_name = "".join(c for c in product_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        safe_name = re.sub(r'[^\w\- ]', '', product_name).rstrip()
         filename = f"{safe_name.lower().replace(' ', '_')}_analysis.txt"
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(f"Business Analysis Report for: {product_name}\n")
-            f.write("=" * 60 + "\n\n")
-            f.write(f"Generated on: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("Tool: CrewAI Adaptive Business Analyzer\n")
-            f.write("=" * 60 + "\n\n")
-            f.write(str(results))
+        # Build the report once and write it in a single call
+        separator = "=" * 60
+        report = (
+            f"Business Analysis Report for: {product_name}\n"
+            f"{separator}\n\n"
+            f"Generated on: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+            "Tool: CrewAI Adaptive Business Analyzer\n"
+            f"{separator}\n\n"
+            f"{results}"
+        )
+        # write_text keeps the platform newline translation of the old open(..., 'w')
+        Path(filename).write_text(report, encoding='utf-8')
         
         print(f"💾 Results saved to: {filename}")
         return filename
@@ -267,7 +364,7 @@ def main():
         
         # Run the adaptive analysis
         print(f"\n🚀 Starting adaptive analysis for '{product_name}'...")
-        results = create_crewai_setup(product_name, max_attempts=3)
+        results = asyncio.run(create_crewai_setup(product_name, max_attempts=3))
         
         # Check if we got valid results
         if isinstance(results, str) and results.startswith("❌"):
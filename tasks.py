@@ -1,14 +1,96 @@
+import os
+import re
+import logging
+import contextvars
+from functools import lru_cache
+from typing import Any
 from crewai import Task
+from pydantic import BaseModel, PrivateAttr, model_validator
 from tools import search_tool
-from agents import market_research_analyst, technology_expert, business_consultant
+from agents import (
+    market_research_analyst, technology_expert, business_consultant,
+    saas_market_analyst, food_market_analyst, hardware_market_analyst,
+)
 
-def create_tasks(product_name):
-    """Create highly focused, time-efficient tasks for the given product name"""
+logger = logging.getLogger(__name__)
+
+# Tool lists shared by every Task built here. Treat them as read-only: CrewAI
+# only appends to a task's tools for delegating agents, and none of ours delegate.
+_SEARCH_TOOLS = [search_tool]
+_NO_TOOLS = []  # No tools to avoid timeouts
+
+def _flatten(value):
+    """Render a JSON array or object answer as one plain string"""
+    if isinstance(value, list):
+        return ", ".join(_flatten(item) for item in value)
+    if isinstance(value, dict):
+        return "; ".join(f"{key}: {_flatten(item)}" for key, item in value.items())
+    return value if isinstance(value, str) else str(value)
+
+class _PlainStrings(BaseModel):
+    """Base for task outputs whose fields are all plain strings"""
     
-    # Task 1: Quick Market Analysis
-    task1 = Task(
-        description=f"""Conduct a rapid market analysis for {product_name}. 
-                        Focus ONLY on essential information. Current date is June 2025.
+    @model_validator(mode='before')
+    @classmethod
+    def _flatten_values(cls, data):
+        # Points like "Top 3 competitors" often come back as arrays or objects;
+        # flattening them here keeps crewai from falling back to its converter,
+        # which costs up to three more LLM calls
+        if isinstance(data, dict):
+            return {key: _flatten(value) for key, value in data.items()}
+        return data
+
+class MarketAnalysis(_PlainStrings):
+    """Structured output of the market analysis task"""
+    target_customer: str
+    market_size: str
+    competitors: str
+    marketing_channel: str
+    price_range: str
+
+class TechAssessment(_PlainStrings):
+    """Structured output of the technical assessment task"""
+    manufacturing_method: str
+    key_equipment: str
+    quality_control: str
+    technical_challenge: str
+
+class BusinessStrategy(_PlainStrings):
+    """Structured business strategy section of the fused report"""
+    business_model: str
+    revenue_stream: str
+    launch_timeline: str
+    success_metric: str
+    biggest_risk: str
+    funding_estimate: str
+
+class FullReport(BaseModel):
+    """Structured output of the fused single-task analysis"""
+    market: MarketAnalysis
+    technology: TechAssessment
+    strategy: BusinessStrategy
+
+# Outputs of main tasks that completed, keyed on (product_name, task_id), so a
+# later fallback attempt (quick or emergency) does not ask for them again
+_RESULT_CACHE = {}
+
+def _compact(template):
+    """Collapse the source indentation of a template into single spaces"""
+    # Whitespace runs tokenize without adding meaning; a single line break is
+    # kept between paragraphs and before numbered items
+    paragraphs = re.split(r'\n\s*\n', template)
+    return "\n".join(re.sub(r' (?=\d\. )', '\n', " ".join(paragraph.split()))
+                     for paragraph in paragraphs)
+
+# Description templates, rendered with str.format_map({'product_name': ...}).
+# The product name goes last so the static rubric forms a stable prompt prefix
+# that provider-side prompt caching can reuse across products and retries.
+
+# Task 1: Quick Market Analysis
+_TASK1_TMPL = _compact("""Conduct a rapid market analysis for the product named below. 
+                        Focus ONLY on essential information. Use the internet search tool
+                        ONLY if you lack confident knowledge for a specific point; otherwise
+                        answer from what you already know.
                         
                         Provide exactly these 5 points (keep each under 2 sentences):
                         1. Primary target customer (age, income, behavior)
@@ -17,16 +99,18 @@ def create_tasks(product_name):
                         4. Best marketing channel (online/offline/hybrid)
                         5. Suggested price range
                         
-                        Total response: Maximum 300 words. Be direct and specific.""",
-        agent=market_research_analyst,
-        expected_output="5-point market analysis covering target customers, market size, competitors, marketing channel, and pricing (max 300 words).",
-        tools=[search_tool]
-    )
+                        Respond with only a JSON object whose keys are target_customer,
+                        market_size, competitors, marketing_channel and price_range,
+                        one per point above. Each value is one plain string (list the
+                        competitors comma-separated). Total response: Maximum 300 words.
+                        
+                        Product under analysis: {product_name}""")
 
-    # Task 2: Technical Assessment (Simplified)
-    task2 = Task(
-        description=f"""Provide a basic technical assessment for {product_name}. 
-                    Focus on practical implementation only.
+# Task 2: Technical Assessment (Simplified)
+_TASK2_TMPL = _compact("""Provide a basic technical assessment for the product named below. 
+                    Focus on practical implementation only. Use the internet search tool
+                    ONLY if you lack confident knowledge for a specific area; otherwise
+                    answer from what you already know.
                     
                     Cover exactly these 4 areas (2 sentences each):
                     1. Manufacturing method (how it's made)
@@ -34,16 +118,18 @@ def create_tasks(product_name):
                     3. Main quality control point
                     4. Biggest technical challenge
                     
-                    Total response: Maximum 250 words. Focus on practicality.""",
-        agent=technology_expert,
-        expected_output="4-point technical assessment covering manufacturing, equipment, quality control, and challenges (max 250 words).",
-        tools=[search_tool]
-    )
+                    Respond with only a JSON object whose keys are manufacturing_method,
+                    key_equipment, quality_control and technical_challenge, one per area above.
+                    Each value is one plain string (list the equipment comma-separated).
+                    Total response: Maximum 250 words. Focus on practicality.
+                    
+                    Product under analysis: {product_name}""")
 
-    # Task 3: Business Strategy (Streamlined)
-    task3 = Task(
-        description=f"""Create a focused business strategy for {product_name} using the previous analyses.
-                    Current date is June 2025.
+# Task 3: Business Strategy (Streamlined)
+_TASK3_TMPL = _compact("""Create a focused business strategy for the product named below using the previous analyses.
+                    Draw mainly on target_customer, market_size and price_range from the market
+                    analysis, and on manufacturing_method and technical_challenge from the
+                    technical assessment.
                     
                     Provide exactly these 6 elements (keep each concise):
                     1. Business model (B2B/B2C/subscription/one-time)
@@ -53,43 +139,264 @@ def create_tasks(product_name):
                     5. Biggest risk
                     6. Initial funding estimate
                     
-                    Total response: Maximum 350 words. Be actionable and realistic.""",
+                    Total response: Maximum 350 words. Be actionable and realistic.
+                    
+                    Product under analysis: {product_name}""")
+
+# Fused task: all three analyses in a single generation (Config.FUSED_MODE)
+_FUSED_TMPL = _compact("""Produce a complete launch analysis for the product named below in one response.
+                    Use the internet search tool ONLY if you lack confident knowledge for a
+                    specific point; otherwise answer from what you already know. Keep each
+                    point under 2 sentences.
+                    
+                    Market analysis:
+                    1. Primary target customer (age, income, behavior)
+                    2. Market size estimate (global/regional)
+                    3. Top 3 direct competitors
+                    4. Best marketing channel (online/offline/hybrid)
+                    5. Suggested price range
+                    
+                    Technical assessment:
+                    1. Manufacturing method (how it's made)
+                    2. Key equipment needed
+                    3. Main quality control point
+                    4. Biggest technical challenge
+                    
+                    Business strategy, built on the two sections above:
+                    1. Business model (B2B/B2C/subscription/one-time)
+                    2. Primary revenue stream
+                    3. Launch timeline (3-6-12 months)
+                    4. Success metric (1 key KPI)
+                    5. Biggest risk
+                    6. Initial funding estimate
+                    
+                    Respond with only a JSON object with three keys. "market" holds
+                    target_customer, market_size, competitors, marketing_channel and
+                    price_range. "technology" holds manufacturing_method, key_equipment,
+                    quality_control and technical_challenge. "strategy" holds business_model,
+                    revenue_stream, launch_timeline, success_metric, biggest_risk and
+                    funding_estimate. Every value inside the three sections is one plain
+                    string (list competitors and equipment comma-separated).
+                    Total response: Maximum 900 words.
+                    
+                    Product under analysis: {product_name}""")
+
+# Emergency tasks: minimal prompts, no research
+_EMERGENCY1_TMPL = _compact("""Quick analysis: Who would buy the product named below and why? 
+                        Answer in exactly 3 sentences. No research needed if obvious.
+                        
+                        Product under analysis: {product_name}""")
+
+_EMERGENCY2_TMPL = _compact("""Simple question: How difficult is it to make the product named below? 
+                        Answer in exactly 2 sentences.
+                        
+                        Product under analysis: {product_name}""")
+
+_EMERGENCY3_TMPL = _compact("""Basic business plan: How would you sell the product named below? 
+                        Answer in exactly 4 sentences covering: how to sell, pricing, timeline, main challenge.
+                        
+                        Product under analysis: {product_name}""")
+
+@lru_cache(maxsize=128)
+def _task_descriptions(product_name):
+    """Render the main task descriptions once per product name"""
+    values = {'product_name': product_name}
+    return (
+        _TASK1_TMPL.format_map(values),
+        _TASK2_TMPL.format_map(values),
+        _TASK3_TMPL.format_map(values),
+    )
+
+@lru_cache(maxsize=128)
+def _emergency_task_descriptions(product_name):
+    """Render the emergency task descriptions once per product name"""
+    values = {'product_name': product_name}
+    return (
+        _EMERGENCY1_TMPL.format_map(values),
+        _EMERGENCY2_TMPL.format_map(values),
+        _EMERGENCY3_TMPL.format_map(values),
+    )
+
+@lru_cache(maxsize=128)
+def _fused_task_description(product_name):
+    """Render the fused task description once per product name"""
+    return _FUSED_TMPL.format_map({'product_name': product_name})
+
+class _RunTask(Task):
+    """Task whose async worker thread keeps the context of the crew run"""
+    # CrewAI starts async tasks in a bare threading.Thread, which begins with an
+    # empty context; without this the run's cancel flag would not reach them
+    _run_context: Any = PrivateAttr(default=None)
+    
+    def execute(self, *args, **kwargs):
+        self._run_context = contextvars.copy_context()
+        return super().execute(*args, **kwargs)
+    
+    def _execute(self, *args, **kwargs):
+        return self._run_context.run(super()._execute, *args, **kwargs)
+
+# Set CREW_DEBUG=1 to run full pydantic validation on every Task while developing
+_DEBUG = os.getenv("CREW_DEBUG") == "1"
+
+def _build_task(**fields):
+    """Build a Task from the trusted literals in this module, skipping validation"""
+    if _DEBUG:
+        return _RunTask(**fields)
+    return _RunTask.model_construct(**fields)
+
+# Market analysts specialized by product category, picked by _route
+_AGENT_ROUTER = {
+    'saas': saas_market_analyst,
+    'food': food_market_analyst,
+    'hardware': hardware_market_analyst,
+}
+
+_CATEGORY_KEYWORDS = {
+    # Only words that name the product type; generic ones like "ai" or
+    # "subscription" also describe food and hardware products
+    'saas': ('app', 'software', 'saas', 'api', 'crm', 'erp'),
+    'food': ('food', 'snack', 'drink', 'beverage', 'coffee', 'tea', 'juice', 'sauce',
+             'bakery', 'chocolate', 'meal', 'organic', 'vegan', 'protein'),
+    'hardware': ('device', 'gadget', 'headphones', 'earbuds', 'speaker', 'phone', 'watch',
+                 'camera', 'drone', 'charger', 'laptop', 'tablet', 'robot', 'sensor'),
+}
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+@lru_cache(maxsize=128)
+def _route(product_name):
+    """Return the category with the most keyword matches, or None if none or tied"""
+    words = set(_WORD_RE.findall(product_name.lower()))
+    scores = sorted(((len(words.intersection(keywords)), category)
+                     for category, keywords in _CATEGORY_KEYWORDS.items()), reverse=True)
+    (best, category), (runner_up, _) = scores[0], scores[1]
+    return category if best > runner_up else None
+
+def _market_agent(product_name):
+    return _AGENT_ROUTER.get(_route(product_name), market_research_analyst)
+
+def _remember_output(product_name, task_id):
+    """Build a Task callback that stores the finished task's output"""
+    def callback(output):
+        _RESULT_CACHE[(product_name, task_id)] = output.raw_output
+    return callback
+
+def create_tasks(product_name):
+    """Create highly focused, time-efficient tasks for the given product name"""
+    
+    # Descriptions are cached; the Task objects are built fresh on every call
+    # because they carry execution state (output, worker thread) once run.
+    # This only holds because the crew driver wraps each set in a new Crew.
+    desc1, desc2, desc3 = _task_descriptions(product_name)
+    
+    # Main tasks that already succeeded on an earlier attempt are not run
+    # again; their output goes to the business strategy as earlier findings
+    market = _RESULT_CACHE.get((product_name, 'market'))
+    technology = _RESULT_CACHE.get((product_name, 'technology'))
+    tasks = []
+    findings = []
+    
+    # Task 1: Quick Market Analysis
+    if market is None:
+        tasks.append(_build_task(
+            description=desc1,
+            agent=_market_agent(product_name),
+            expected_output="JSON market analysis with target_customer, market_size, competitors, marketing_channel, and price_range (max 300 words).",
+            output_pydantic=MarketAnalysis,
+            callback=_remember_output(product_name, 'market'),
+            tools=_SEARCH_TOOLS,
+            async_execution=True  # Independent of task2, runs alongside it
+        ))
+    else:
+        findings.append(f"Market analysis: {market}")
+
+    # Task 2: Technical Assessment (Simplified)
+    if technology is None:
+        tasks.append(_build_task(
+            description=desc2,
+            agent=technology_expert,
+            expected_output="JSON technical assessment with manufacturing_method, key_equipment, quality_control, and technical_challenge (max 250 words).",
+            output_pydantic=TechAssessment,
+            callback=_remember_output(product_name, 'technology'),
+            tools=_SEARCH_TOOLS,
+            async_execution=True
+        ))
+    else:
+        findings.append(f"Technical assessment: {technology}")
+    
+    if findings:
+        desc3 = desc3 + "\n\nEarlier findings:\n" + "\n".join(findings)
+
+    # Task 3: Business Strategy (Streamlined)
+    task3 = _build_task(
+        description=desc3,
         agent=business_consultant,
         expected_output="6-point business strategy with model, revenue, timeline, metrics, risks, and funding (max 350 words).",
-        context=[task1, task2],
-        tools=[search_tool]
+        context=list(tasks),  # Waits for any async tasks still to run
+        tools=_SEARCH_TOOLS
     )
     
-    return [task1, task2, task3]
+    return (*tasks, task3)
+
+def create_tasks_fused(product_name):
+    """Create a single task that covers market, technical and business analysis"""
+    
+    # One LLM round-trip instead of three, at the cost of the specialist agents
+    task = _build_task(
+        description=_fused_task_description(product_name),
+        agent=business_consultant,
+        expected_output="JSON report with market, technology and strategy sections (max 900 words).",
+        output_pydantic=FullReport,
+        tools=_SEARCH_TOOLS
+    )
+    
+    return (task,)
 
 def create_emergency_tasks(product_name):
     """Create ultra-simplified tasks for when the main tasks are failing"""
     
-    print("🆘 Creating emergency simplified tasks...")
+    logger.warning("Creating emergency simplified tasks")
     
-    task1 = Task(
-        description=f"""Quick analysis: Who would buy {product_name} and why? 
-                        Answer in exactly 3 sentences. No research needed if obvious.""",
-        agent=market_research_analyst,
-        expected_output="3-sentence customer analysis.",
-        tools=[]  # No tools to avoid timeouts
-    )
+    desc1, desc2, desc3 = _emergency_task_descriptions(product_name)
+    
+    # Main-task results that already succeeded replace their emergency
+    # counterparts, and are handed to the business plan as earlier findings
+    market = _RESULT_CACHE.get((product_name, 'market'))
+    technology = _RESULT_CACHE.get((product_name, 'technology'))
+    tasks = []
+    findings = []
+    
+    if market is None:
+        tasks.append(_build_task(
+            description=desc1,
+            agent=_market_agent(product_name),
+            expected_output="3-sentence customer analysis.",
+            tools=_NO_TOOLS,
+            async_execution=True  # Independent of task2, runs alongside it
+        ))
+    else:
+        findings.append(f"Market analysis: {market}")
 
-    task2 = Task(
-        description=f"""Simple question: How difficult is it to make {product_name}? 
-                        Answer in exactly 2 sentences.""",
-        agent=technology_expert,
-        expected_output="2-sentence technical difficulty assessment.",
-        tools=[]
-    )
+    if technology is None:
+        tasks.append(_build_task(
+            description=desc2,
+            agent=technology_expert,
+            expected_output="2-sentence technical difficulty assessment.",
+            tools=_NO_TOOLS,
+            async_execution=True
+        ))
+    else:
+        findings.append(f"Technical assessment: {technology}")
+    
+    if findings:
+        desc3 = desc3 + "\n\nEarlier findings:\n" + "\n".join(findings)
 
-    task3 = Task(
-        description=f"""Basic business plan: How would you sell {product_name}? 
-                        Answer in exactly 4 sentences covering: how to sell, pricing, timeline, main challenge.""",
+    task3 = _build_task(
+        description=desc3,
         agent=business_consultant,
         expected_output="4-sentence basic business plan.",
-        context=[task1, task2],
-        tools=[]
+        context=list(tasks),  # Waits for any async tasks still to run
+        tools=_NO_TOOLS
     )
     
-    return [task1, task2, task3]
\ No newline at end of file
+    return (*tasks, task3)